@@ -1,9 +1,22 @@
 #!/usr/bin/env python3
 
+import os
+import re
 import subprocess
 import sys
 import time
 
+OVN_CONTROLLER_LOG = '/var/log/ovn/ovn-controller.log'
+READ_SIZE = 65536
+POLL_INTERVAL = 0.025
+FULL_CHECK_INTERVAL = 60
+
+_STRIP_SPACES = str.maketrans('', '', ' ')
+_RE_VOLATILE = re.compile(
+    r'\b(?:duration|n_packets|n_bytes|idle_age)=[^ ,]*', re.ASCII)
+_RE_CLASSIFY = re.compile(
+    rb'(ofctrl_add_flow|removing installed flow|ofctrl_put not needed)')
+
 
 def extract_flow_from_logline(line: str) -> str:
     """Extract flow from debug log.
@@ -21,13 +34,10 @@ def extract_flow_from_logline(line: str) -> str:
     'cookie=0x33d9a01c,table=20,priority=100,reg0=0xac10005b,reg15=0x3,'
     'metadata=0x144,actions=set_field:fa:16:3e:5b:d3:19->eth_dst,resubmit(,21)'
     """
-    flow_out = line.rstrip().split('flow:')[1]
-    for replacement in (
-            (' ', '',),
-            ('table_id=', 'table='),
-            ('cookie=', 'cookie=0x')):
-        flow_out = flow_out.replace(replacement[0], replacement[1])
-    return flow_out
+    flow_out = line.rstrip().split('flow:', 1)[1]
+    return (flow_out.translate(_STRIP_SPACES)
+            .replace('table_id=', 'table=')
+            .replace('cookie=', 'cookie=0x'))
 
 
 def extract_flow_from_ofctl(line: str) -> str:
@@ -46,46 +56,93 @@ def extract_flow_from_ofctl(line: str) -> str:
     'metadata=0x144,actions=set_field:fa:16:3e:5b:d3:19->eth_dst,'
     'resubmit(,21)'
     """
-    kv_pairs = [
-        kv_pair
-        for kv_pair in line.rstrip().replace(' ', ',').split(',')
-        if kv_pair and ('duration' not in kv_pair
-            and 'n_packets' not in kv_pair
-            and 'n_bytes' not in kv_pair
-            and 'idle_age' not in kv_pair)
-    ]
-    return ','.join(kv_pairs)
-
-
-def check_ofctl(expected_flows: set):
-    cp = subprocess.run(
-        ('ovs-ofctl', '-O', 'OpenFlow15', 'dump-flows', 'br-int', 'table=20'),
-        capture_output=True, check=True, universal_newlines=True)
-
-    ofctl_flows = set()
-    for line in cp.stdout.splitlines():
-        ofctl_flows.add(extract_flow_from_ofctl(line))
+    flow_out = _RE_VOLATILE.sub('', line)
+    return ','.join(flow_out.replace(',', ' ').split())
+
+
+def check_ofctl(expected_flows: set) -> set:
+    """Check that the expected flows are installed in br-int table 20.
+
+    Returns the subset of expected_flows missing from the ovs-ofctl dump.
+    """
+    with subprocess.Popen(
+            ('ovs-ofctl', '-O', 'OpenFlow15', 'dump-flows', 'br-int',
+             'table=20'),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True) as proc:
+        ofctl_flows = {extract_flow_from_ofctl(line) for line in proc.stdout}
+        stderr = proc.stderr.read()
+    if proc.returncode:
+        raise subprocess.CalledProcessError(
+            proc.returncode, proc.args, stderr=stderr)
     missing_flows = expected_flows.difference(ofctl_flows)
     if missing_flows:
         print('MISSING FLOWS: {}'.format(missing_flows))
     else:
         print('All flows installed!')
+    return missing_flows
 
 
-with open('/var/log/ovn/ovn-controller.log') as logf:
-    # Seek to EOF
-    logf.seek(0, 2)
-    expected_flows = set()
-    while True:
-        line = logf.readline()
-        if not line or not line.endswith('\n'):
-            time.sleep(0.025)
-            print('expected_flows: {}'.format(len(expected_flows)))
-            continue
-        if 'ofctrl_put not needed' in line and len(expected_flows):
-            check_ofctl(expected_flows)
-        if 'ofctrl_add_flow' in line and 'table_id=20' in line:
-            expected_flows.add(extract_flow_from_logline(line))
-        if 'removing installed flow' in line and 'table_id=20' in line:
-            expected_flows.remove(extract_flow_from_logline(line))
+def loop(log_path: str = OVN_CONTROLLER_LOG):
+    """Follow the ovn-controller log and verify table 20 flows.
 
+    The log is read in large chunks straight from the file descriptor and
+    split into lines from a persistent buffer, so a burst of log output is
+    handled in one wakeup and incomplete lines are kept until the rest of
+    them is written. Lines are matched as bytes and only decoded when a
+    flow has to be extracted from them.
+
+    Only the flows added since the last successful check are verified when
+    ovn-controller reports it is idle; all expected flows are checked
+    again every FULL_CHECK_INTERVAL seconds to catch flows that went
+    missing after they were verified.
+    """
+    fd = os.open(log_path, os.O_RDONLY)
+    try:
+        # Seek to EOF
+        os.lseek(fd, 0, os.SEEK_END)
+        buf = bytearray()
+        expected_flows = set()
+        pending_flows = set()
+        next_full_check = 0.0
+        while True:
+            data = os.read(fd, READ_SIZE)
+            if not data:
+                # select() always reports regular files as readable, so
+                # there is nothing to block on at EOF; wait for more data.
+                time.sleep(POLL_INTERVAL)
+                print('expected_flows: {}'.format(len(expected_flows)))
+                continue
+            buf += data
+            while (nl := buf.find(b'\n')) != -1:
+                line = bytes(buf[:nl])
+                del buf[:nl + 1]
+                m = _RE_CLASSIFY.search(line)
+                if m is None:
+                    continue
+                event = m.group(1)
+                if event == b'ofctrl_put not needed':
+                    if not expected_flows:
+                        continue
+                    now = time.monotonic()
+                    if now >= next_full_check:
+                        pending_flows = check_ofctl(expected_flows)
+                        next_full_check = now + FULL_CHECK_INTERVAL
+                    elif pending_flows:
+                        pending_flows = check_ofctl(pending_flows)
+                elif b'table_id=20' not in line:
+                    continue
+                elif event == b'ofctrl_add_flow':
+                    flow = extract_flow_from_logline(line.decode('ascii'))
+                    expected_flows.add(flow)
+                    pending_flows.add(flow)
+                else:
+                    flow = extract_flow_from_logline(line.decode('ascii'))
+                    expected_flows.discard(flow)
+                    pending_flows.discard(flow)
+    finally:
+        os.close(fd)
+
+
+if __name__ == '__main__':
+    loop()